@@ -0,0 +1,9 @@
+-- Optional indexes used by the scripts in the tools folder.
+-- They are not needed by SlurpSlurp itself, run this once if you use the tools on a big database.
+
+-- invites_extractor.py: lets the ILIKE prefilter use a bitmap index scan instead of a full scan
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_messages_content_trgm ON messages USING gin (content gin_trgm_ops);
+
+-- prepare_dataset.py: used by the reply-chain recursion (reply.referenced_message_id = rc.id)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_messages_referenced ON messages (referenced_message_id) WHERE referenced_message_id IS NOT NULL;
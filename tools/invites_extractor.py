@@ -1,47 +1,24 @@
 import sys
-import re
 import psycopg2
-from urllib.parse import urlparse
+from contextlib import closing
 
 def extract_invite_codes_from_db(db_url):
-    result = urlparse(db_url)
-    username = result.username
-    password = result.password
-    database = result.path[1:]
-    hostname = result.hostname
-    port = result.port
-
-    conn = psycopg2.connect(
-        dbname=database,
-        user=username,
-        password=password,
-        host=hostname,
-        port=port
-    )
-    cur = conn.cursor()
-
-    query = """
-    SELECT messages.content FROM messages WHERE content ~ '(https?:\/\/)?(www\.)?((discordapp\.com\/invite)|(discord\.gg))\/(\w+)'
+    # Capture and dedup happen in Postgres so only unique codes cross the wire.
+    # The ILIKE prefilter can use the trigram index from sql_scripts/tools_indexes.sql
+    query = r"""
+    SELECT DISTINCT (regexp_matches(content, '(?:https?://)?(?:www\.)?(?:discordapp\.com/invite|discord\.gg)/(\w+)', 'g'))[1] AS code
+    FROM messages
+    WHERE content ILIKE '%discord.gg/%' OR content ILIKE '%discordapp.com/invite/%'
+    ORDER BY code
     """
-    cur.execute(query)
-    rows = cur.fetchall()
-
-    invite_code_pattern = re.compile(r'(?:https?://)?(?:www\.)?(?:discordapp\.com/invite|discord\.gg)/(\w+)')
-
-    invite_codes = []
-    for row in rows:
-        content = row[0]
-        matches = invite_code_pattern.findall(content)
-        invite_codes.extend(matches)
-
-    invite_codes = list(set(invite_codes))
 
-    with open('invites.txt', 'w') as f:
-        for code in invite_codes:
-            f.write(code + '\n')
+    with closing(psycopg2.connect(db_url)) as conn, conn, conn.cursor(name='inv') as cur:
+        cur.itersize = 10000
+        cur.execute(query)
+        invite_codes = [code for (code,) in cur]
 
-    cur.close()
-    conn.close()
+    with open('invites.txt', 'w', buffering=1 << 20) as f:
+        f.writelines(code + '\n' for code in invite_codes)
 
     return invite_codes
 
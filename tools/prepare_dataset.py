@@ -1,47 +1,89 @@
 import psycopg2
-import json
+import orjson
+import re
 import argparse
 import sys
-import random
+import os
+import hashlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing
+from itertools import chain, islice
+from typing import Iterable, Iterator, Optional
 from tqdm import tqdm
 
 MAX_INPUT_CHARS = 35000
 MAX_OUTPUT_CHARS = 5000
 MAX_CHAIN_LENGTH = 10
 MAX_CHAINS = 100
-
-def preprocess_text(text: str, author_id_to_role: dict = None) -> str:
-    if not isinstance(text, str):
+CHAIN_BATCH_SIZE = 16
+
+# Discord tokens rewritten by preprocess_text, matched in a single pass.
+# A URL or a code block anywhere in the text discards the whole message
+_TOKEN_RE = re.compile(
+    r"(?P<url>https?://\S+)"
+    r"|(?P<code>```[\s\S]*?```)"
+    r"|(?P<mention><@!?(?P<mention_id>\d+)>)"
+    r"|(?P<role><@&\d+>)"
+    r"|(?P<channel><#\d+>)"
+    r"|(?P<emoji><:[a-zA-Z0-9-_]{2,32}:\d+>)"
+)
+
+_TOKEN_REPLACEMENTS = {
+    "role": "@role",
+    "channel": "#channel",
+    "emoji": "",
+}
+
+_MENTION_PLACEHOLDER_RE = re.compile(r"\x00(\d+)\x00")
+
+class _DiscardText(Exception):
+    """Raised from a substitution callback to drop the text being processed"""
+
+def _replace_token(match):
+    kind = match.lastgroup
+    if kind == "url" or kind == "code":
+        raise _DiscardText
+    if kind == "mention":
+        return f"\x00{match.group('mention_id')}\x00"
+
+    return _TOKEN_REPLACEMENTS[kind]
+
+def _clean_text(text: str) -> str:
+    """Does all the regex work of preprocess_text but leaves user mentions as \\x00id\\x00 placeholders"""
+    try:
+        text = _TOKEN_RE.sub(_replace_token, text)
+    except _DiscardText:
         return ""
 
-    import re
+    return " ".join(text.split())
 
-    if author_id_to_role:
-        def replace_mention(match):
-            mentioned_id = match.group(1)
-            if mentioned_id in author_id_to_role:
-                return f"@{author_id_to_role[mentioned_id]}"
-            else:
-                return ""
+def _mention_replacement(author_id_to_role: dict = None):
+    """Builds the re.sub replacement used by _render_mentions, once per role mapping"""
+    if not author_id_to_role:
+        return "@user"
 
-        text = re.sub(r"<@!?(\d+)>", replace_mention, text)
-    else:
-        text = re.sub(r"<@!?\d+>", "@user", text)
+    def replace_mention(match):
+        mentioned_id = match.group(1)
+        if mentioned_id in author_id_to_role:
+            return f"@{author_id_to_role[mentioned_id]}"
+        else:
+            return ""
 
-    text = re.sub(r"<@&\d+>", "@role", text)
-    text = re.sub(r"<#\d+>", "#channel", text)
+    return replace_mention
 
-    if re.search(r"https?://\S+", text):
-        return ""
-
-    if re.search(r"``````", text, flags=re.DOTALL):
-        return ""
+def _render_mentions(text: str, replacement) -> str:
+    """Resolves the mention placeholders left by _clean_text"""
+    if "\x00" not in text:
+        return text
 
-    text = re.sub(r"<:[a-zA-Z0-9-_]{2,32}:\d+>", "", text)
+    text = _MENTION_PLACEHOLDER_RE.sub(replacement, text)
 
-    text = re.sub(r"\s+", " ", text).strip()
+    # Dropped mentions can leave doubled or trailing spaces behind
+    return " ".join(text.split())
 
-    return text
+def preprocess_text(text: str, author_id_to_role: dict = None) -> str:
+    return _render_mentions(_clean_text(text), _mention_replacement(author_id_to_role))
 
 def assign_last_speaker_as_assistant(messages):
     if not messages:
@@ -60,30 +102,53 @@ def assign_last_speaker_as_assistant(messages):
 
     return messages
 
-def get_reply_chains(db_dsn: str, min_chain_length: int = 2) -> list:
+def get_reply_chains(db_dsn: str, min_chain_length: int = 2) -> Iterator[tuple]:
+    """Streams the longest reply chain of each root from the database"""
     print(f"[*] Connecting to PostgreSQL database...")
 
     try:
-        with psycopg2.connect(db_dsn) as conn:
+        with closing(psycopg2.connect(db_dsn)) as conn, conn:
+            # Read-only transaction: the named cursor below needs one, autocommit isn't an option
+            conn.set_session(readonly=True)
+
             with conn.cursor() as cursor:
-                query = """
+                # Any valid index of the messages table the query resolves to whose
+                # first key column is referenced_message_id, composite ones included
+                cursor.execute("""
+                    SELECT 1
+                    FROM pg_index i
+                    JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+                    WHERE i.indrelid = 'messages'::regclass
+                      AND i.indisvalid
+                      AND a.attname = 'referenced_message_id'
+                """)
+                if cursor.fetchone() is None:
+                    print("[WARNING] No index on messages.referenced_message_id, the reply chains lookup will be slow.", file=sys.stderr)
+                    print("[WARNING] Run sql_scripts/tools_indexes.sql once to create it.", file=sys.stderr)
+
+            # Named cursor: rows are fetched from the server in itersize chunks
+            with conn.cursor(name="reply_chains") as cursor:
+                cursor.itersize = 2000
+                # Contents with a URL or a code block are blanked server-side: preprocess_text would
+                # discard them anyway, this keeps the chain intact without sending the text over the wire.
+                # No LIMIT: rejected and duplicate chains would eat into it, the writer stops reading
+                # once MAX_CHAINS records are written instead
+                query = r"""
                 WITH RECURSIVE reply_chains AS (
                     SELECT
                         m.id,
-                        m.channel_id,
-                        m.author_id,
-                        m.content,
-                        u.username,
                         m.id as root_id,
                         1 as depth,
-                        ARRAY[m.id] as chain_path,
-                        ARRAY[m.id] as msg_ids,
-                        ARRAY[m.author_id] as author_ids,
-                        ARRAY[u.username] as usernames,
-                        ARRAY[m.content] as contents
+                        ARRAY[m.author_id::text] as author_ids,
+                        ARRAY[CASE WHEN m.content ~ 'https?://\S|```.*```' THEN '' ELSE m.content END] as contents
                     FROM messages m
-                    JOIN users u ON m.author_id = u.id
                     WHERE m.referenced_message_id IS NULL
+                      -- Only seed the recursion with roots that actually got replies
+                      AND m.id IN (
+                          SELECT referenced_message_id
+                          FROM messages
+                          WHERE referenced_message_id IS NOT NULL
+                      )
                       AND m.content IS NOT NULL
                       AND length(trim(m.content)) > 0
                       AND m.deleted_at IS NULL
@@ -92,143 +157,177 @@ def get_reply_chains(db_dsn: str, min_chain_length: int = 2) -> list:
 
                     SELECT
                         reply.id,
-                        reply.channel_id,
-                        reply.author_id,
-                        reply.content,
-                        reply_user.username,
                         rc.root_id,
                         rc.depth + 1,
-                        rc.chain_path || reply.id,
-                        rc.msg_ids || reply.id,
-                        rc.author_ids || reply.author_id,
-                        rc.usernames || reply_user.username,
-                        rc.contents || reply.content
+                        rc.author_ids || reply.author_id::text,
+                        rc.contents || CASE WHEN reply.content ~ 'https?://\S|```.*```' THEN '' ELSE reply.content END
                     FROM messages reply
-                    JOIN users reply_user ON reply.author_id = reply_user.id
                     JOIN reply_chains rc ON reply.referenced_message_id = rc.id
                     WHERE reply.content IS NOT NULL
                       AND length(trim(reply.content)) > 0
                       AND reply.deleted_at IS NULL
                       AND rc.depth < %s
-                      AND NOT (reply.id = ANY(rc.chain_path))
+                      -- Snowflake ids grow over time and a reply is always newer than
+                      -- the message it references, so this is enough to rule out cycles
+                      AND reply.id > rc.id
                 )
-                SELECT
+                SELECT DISTINCT ON (root_id)  -- Only the longest chain of each root
                     root_id,
-                    channel_id,
-                    depth,
-                    msg_ids,
                     author_ids,
-                    usernames,
                     contents
                 FROM reply_chains
                 WHERE depth >= %s  -- Use the min_chain_length parameter
-                ORDER BY root_id, depth DESC
-                LIMIT %s;
+                ORDER BY root_id, depth DESC;
                 """
 
-                cursor.execute(query, (MAX_CHAIN_LENGTH, min_chain_length, MAX_CHAINS * 2))
-                chains = cursor.fetchall()
-
-                print(f"[+] {len(chains)} chains of at least {min_chain_length} messages found.")
-                return chains
+                cursor.execute(query, (MAX_CHAIN_LENGTH, min_chain_length))
+                yield from cursor
 
     except psycopg2.Error as e:
         print(f"[ERROR] PostgreSQL error: {e}", file=sys.stderr)
         sys.exit(1)
 
 def create_conversation_record(chain_data: tuple) -> dict:
-    try:
-        root_id, channel_id, depth, msg_ids, author_ids, usernames, contents = chain_data
+    root_id, author_ids, contents = chain_data
+    if len(author_ids) != len(contents):
+        return None
+
+    messages = []
+    person_mapping = {}
+    cleaned_messages = []
+    known_length = 0
+
+    # author_ids and contents are parallel arrays: label the authors and run
+    # the regex pass in the same loop
+    for author_id, content in zip(author_ids, contents):
+        if author_id not in person_mapping:
+            person_mapping[author_id] = f"Person{chr(65 + len(person_mapping))}"
+
+        template = _clean_text(content)
+        cleaned_messages.append((author_id, template))
+
+        # Texts without mentions are kept as-is, so their length is a lower bound
+        # of the record size: stop before cleaning the rest of an oversized chain
+        if len(template) >= 2 and "\x00" not in template:
+            known_length += len(template)
+            if known_length > MAX_INPUT_CHARS:
+                return None
+
+    # author_ids come out of the query as text, like the mentioned ids
+    author_id_to_role = person_mapping
+
+    # Cleaned texts keep their mention placeholders so a role change
+    # only needs the mentions re-rendered, not the whole regex pass
+    templates = []
+    message_authors = []
+    replacement = _mention_replacement(author_id_to_role)
+
+    for author_id, template in cleaned_messages:
+        processed_content = _render_mentions(template, replacement)
+        if not processed_content or len(processed_content.strip()) < 2:
+            continue
+
+        messages.append({
+            "role": person_mapping[author_id],
+            "content": processed_content
+        })
+        templates.append(template)
+        message_authors.append(author_id)
+
+    if len(messages) < 2:
+        return None
 
-        messages = []
-        person_mapping = {}
-        person_counter = 0
+    messages = assign_last_speaker_as_assistant(messages)
 
-        if len(msg_ids) != len(author_ids) or len(author_ids) != len(usernames) or len(usernames) != len(contents):
-            return None
+    final_author_id_to_role = {}
+    for msg, author_id in zip(messages, message_authors):
+        final_author_id_to_role[author_id] = msg["role"]
 
-        for i in range(len(msg_ids)):
-            author_id = author_ids[i]
+    if final_author_id_to_role != author_id_to_role:
+        replacement = _mention_replacement(final_author_id_to_role)
+        for msg, template in zip(messages, templates):
+            reprocessed_content = _render_mentions(template, replacement)
+            if reprocessed_content and len(reprocessed_content.strip()) >= 2:
+                msg["content"] = reprocessed_content
 
-            if author_id not in person_mapping:
-                person_mapping[author_id] = f"Person{chr(65 + person_counter)}"
-                person_counter += 1
+    total_length = sum(len(msg["content"]) for msg in messages)
+    if total_length > MAX_INPUT_CHARS:
+        return None
 
-        author_id_to_role = {str(author_id): role for author_id, role in person_mapping.items()}
+    return {"messages": messages}
 
-        for i in range(len(msg_ids)):
-            author_id = author_ids[i]
-            username = usernames[i]
-            content = contents[i]
+def unique_chains(chains: Iterable[tuple]) -> Iterator[tuple]:
+    """Drops chains identical to one already seen"""
+    seen_chains = set()
 
-            processed_content = preprocess_text(content, author_id_to_role)
-            if not processed_content or len(processed_content.strip()) < 2:
-                continue
+    for chain_data in chains:
+        # Identical chains ("lol", "ok"...) under different roots would produce the same record.
+        # A 16-byte digest keeps the set small however many chains the cursor returns
+        chain_key = hashlib.blake2b(orjson.dumps([chain_data[1], chain_data[2]]), digest_size=16).digest()
+        if chain_key in seen_chains:
+            continue
+        seen_chains.add(chain_key)
+        yield chain_data
 
-            role = person_mapping[author_id]
+def encode_chain(chain_data: tuple) -> Optional[bytes]:
+    """Returns the JSONL line of a chain, or None if it isn't valid"""
+    record = create_conversation_record(chain_data)
+    if record and len(record["messages"]) >= 2:
+        return orjson.dumps(record) + b"\n"
 
-            messages.append({
-                "role": role,
-                "content": processed_content
-            })
+    return None
 
-        if len(messages) < 2:
-            return None
+def encode_chain_batch(chain_batch: list) -> list:
+    """Runs encode_chain over a batch of chains. Runs in a worker process"""
+    return [encode_chain(chain_data) for chain_data in chain_batch]
 
-        messages = assign_last_speaker_as_assistant(messages)
+def encode_chains(executor: ProcessPoolExecutor, chains: Iterable[tuple], max_in_flight: int) -> Iterator[Optional[bytes]]:
+    """Yields encode_chain results in order, pulling chains only as batches complete"""
+    chains = iter(chains)
+    in_flight = deque()
 
-        final_author_id_to_role = {}
-        for i, msg in enumerate(messages):
-            original_author_id = str(author_ids[i])
-            final_author_id_to_role[original_author_id] = msg["role"]
+    # Unlike executor.map, which submits the whole iterable upfront, this keeps
+    # at most max_in_flight batches queued so the cursor is read lazily
+    for chain_batch in iter(lambda: list(islice(chains, CHAIN_BATCH_SIZE)), []):
+        in_flight.append(executor.submit(encode_chain_batch, chain_batch))
+        if len(in_flight) >= max_in_flight:
+            yield from in_flight.popleft().result()
 
-        if final_author_id_to_role != author_id_to_role:
-            for i, msg in enumerate(messages):
-                original_content = contents[i]
-                reprocessed_content = preprocess_text(original_content, final_author_id_to_role)
-                if reprocessed_content and len(reprocessed_content.strip()) >= 2:
-                    msg["content"] = reprocessed_content
+    while in_flight:
+        yield from in_flight.popleft().result()
 
-        total_length = sum(len(msg["content"]) for msg in messages)
-        if total_length > MAX_INPUT_CHARS:
-            return None
+def write_chains_to_jsonl(chains: Iterable[tuple], output_filepath: str) -> int:
+    """Writes conversation chains to JSONL format, returns the number of records written"""
+    print(f"[*] Writing chains to {output_filepath}...")
 
-        return {"messages": messages}
+    valid_records_count = 0
 
-    except Exception as e:
-        return None
+    # Regex and serialization are CPU-bound, workers build the records while
+    # this process only writes them, in root order
+    workers = os.cpu_count() or 1
 
-def write_chains_to_jsonl(chains: list, output_filepath: str):
-    """Writes conversation chains to JSONL format"""
-    print(f"[*] Writing {len(chains)} chains to {output_filepath}...")
+    with ProcessPoolExecutor(max_workers=workers) as executor, open(output_filepath, "wb", buffering=1 << 20) as f:
+        lines = encode_chains(executor, unique_chains(chains), max_in_flight=2 * workers)
 
-    valid_records_count = 0
-    unique_chains = {}
-
-    with open(output_filepath, "w", encoding="utf-8") as f:
-        for chain_data in tqdm(chains, desc="Processing chains"):
-            try:
-                record = create_conversation_record(chain_data)
-                if record and len(record["messages"]) >= 2:
-                    root_id = chain_data[0]
-                    if root_id not in unique_chains:
-                        unique_chains[root_id] = record
-                        f.write(json.dumps(record, ensure_ascii=False) + "\n")
-                        valid_records_count += 1
-
-                        # Debug: display some examples
-                        if valid_records_count <= 3:
-                            print(f"[DEBUG] Example chain #{valid_records_count}:")
-                            for msg in record['messages']:
-                                print(f"  - {msg['role']}: {msg['content'][:50]}...")
-
-                        if valid_records_count >= MAX_CHAINS:
-                            break
-
-            except Exception as e:
+        for line in tqdm(lines, desc="Processing chains"):
+            if line is None:
                 continue
 
+            f.write(line)
+            valid_records_count += 1
+
+            # Debug: display some examples
+            if valid_records_count <= 3:
+                print(f"[DEBUG] Example chain #{valid_records_count}:")
+                for msg in orjson.loads(line)['messages']:
+                    print(f"  - {msg['role']}: {msg['content'][:50]}...")
+
+            if valid_records_count >= MAX_CHAINS:
+                executor.shutdown(cancel_futures=True)
+                break
+
     print(f"[+] {valid_records_count} valid chains written to {output_filepath}.")
+    return valid_records_count
 
 def generate_reply_chains_dataset(
     db_dsn: str,
@@ -239,13 +338,24 @@ def generate_reply_chains_dataset(
     global MAX_CHAINS
     MAX_CHAINS = max_chains
 
-    chains = get_reply_chains(db_dsn, min_chain_length)
+    reply_chains = get_reply_chains(db_dsn, min_chain_length)
 
-    if not chains:
+    # Connect and run the query before the output file gets truncated:
+    # a bad DSN or a query error must not wipe an existing dataset
+    first_chain = next(reply_chains, None)
+    if first_chain is None:
+        print(f"[WARNING] No chains of at least {min_chain_length} messages found.")
+        return
+
+    # DISTINCT ON makes the server build and sort every chain before the first
+    # fetch, closing the generator only stops the transfer of the remaining rows
+    with closing(reply_chains):
+        valid_records_count = write_chains_to_jsonl(chain((first_chain,), reply_chains), output_path)
+
+    if not valid_records_count:
         print(f"[WARNING] No chains of at least {min_chain_length} messages found.")
         return
 
-    write_chains_to_jsonl(chains, output_path)
     print(f"\n[SUCCESS] Dataset generated successfully: {output_path}")
     print(f"[INFO] Chains with at least {min_chain_length} messages")
 
@@ -300,6 +410,10 @@ if __name__ == "__main__":
         print(f"[ERROR] min-chain-length must be at least 2", file=sys.stderr)
         sys.exit(1)
 
+    if args.max_chains < 1:
+        print(f"[ERROR] max-chains must be at least 1", file=sys.stderr)
+        sys.exit(1)
+
     generate_reply_chains_dataset(
         args.db_dsn,
         args.output_file,